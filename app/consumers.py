@@ -1,13 +1,37 @@
-import json
 import asyncio
+import msgpack
+import orjson
 from channels.generic.websocket import AsyncWebsocketConsumer
 from django.contrib.auth import get_user_model
 from channels.db import database_sync_to_async
+from django.db import connection
+from django.utils import timezone
 from .models import Conversation, Message
+from .presence import set_online, set_offline
+from .unread import invalidate_unread
 
 User = get_user_model()
 
 
+# reused across frames; consumers run on a single event loop thread
+_packer = msgpack.Packer()
+
+
+def _pack(data):
+    return _packer.pack(data)
+
+
+# constant frames, packed once at import
+PONG_PAYLOAD = _pack({"type": "pong"})
+
+
+# forward at most one typing event per second per socket
+TYPING_INTERVAL = 1.0
+
+# largest client frame ChatConsumer will parse, in bytes
+MAX_FRAME_SIZE = 8192
+
+
 class PresenceConsumer(AsyncWebsocketConsumer):
 
     async def connect(self):
@@ -27,16 +51,19 @@ class PresenceConsumer(AsyncWebsocketConsumer):
         )
 
         # mark user online
-        await self.update_user_status(True)
+        await set_online(self.user.id)
 
         # notify others user is online
         await self.channel_layer.group_send(
             self.presence_group,
             {
                 "type": "user_presence",
-                "user_id": self.user.id,
-                "username": self.user.username,
-                "is_online": True,
+                "payload": _pack({
+                    "type": "presence",
+                    "user_id": self.user.id,
+                    "username": self.user.username,
+                    "is_online": True,
+                }),
             },
         )
 
@@ -44,16 +71,22 @@ class PresenceConsumer(AsyncWebsocketConsumer):
 
     async def disconnect(self, close_code):
         if hasattr(self, "presence_group"):
-            await self.update_user_status(False)
+            await asyncio.gather(
+                set_offline(self.user.id),
+                self.update_user_status(False),
+            )
 
             # notify others user is offline
             await self.channel_layer.group_send(
                 self.presence_group,
                 {
                     "type": "user_presence",
-                    "user_id": self.user.id,
-                    "username": self.user.username,
-                    "is_online": False,
+                    "payload": _pack({
+                        "type": "presence",
+                        "user_id": self.user.id,
+                        "username": self.user.username,
+                        "is_online": False,
+                    }),
                 },
             )
 
@@ -62,20 +95,24 @@ class PresenceConsumer(AsyncWebsocketConsumer):
                 self.channel_name
             )
 
+    async def receive(self, text_data=None, bytes_data=None):
+        # any frame from the client (heartbeat ping) keeps the user online;
+        # the heartbeat also refreshes the persisted is_online/last_seen snapshot
+        await asyncio.gather(
+            set_online(self.user.id),
+            self.update_user_status(True),
+        )
+
     async def user_presence(self, event):
-        await self.send(text_data=json.dumps({
-            "type": "presence",
-            "user_id": event["user_id"],
-            "username": event["username"],
-            "is_online": event["is_online"],
-        }))
+        await self.send(bytes_data=event["payload"])
 
     @database_sync_to_async
     def update_user_status(self, status):
         try:
-            user = User.objects.get(id=self.user.id)
-            user.is_online = status
-            user.save(update_fields=["is_online"])
+            User.objects.filter(id=self.user.id).update(
+                is_online=status,
+                last_seen=timezone.now()
+            )
         except Exception as e:
             print("Status update error:", e)
 
@@ -93,155 +130,273 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
         # create consistent room name
         user_ids = sorted([self.user.id, int(self.other_user_id)])
+
+        # conversation is fixed for the lifetime of this socket
+        self.conversation_id = await self.get_or_create_conversation_id(*user_ids)
+
+        if self.conversation_id is None:
+            await self.close()
+            return
+
         self.room_group_name = f"chat_{user_ids[0]}_{user_ids[1]}"
 
-        # join room
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
+        # per-member groups for events only the other participant needs
+        self.member_group_name = f"{self.room_group_name}_{self.user.id}"
+        self.peer_group_name = f"{self.room_group_name}_{self.other_user_id}"
+
+        self.last_typing_at = 0.0
+        self.is_typing = False
+
+        # typing frames only depend on this socket's user; pack them once
+        self.typing_payload = _pack({
+            "type": "typing",
+            "user_id": self.user.id,
+        })
+        self.stop_typing_payload = _pack({
+            "type": "stop_typing",
+            "user_id": self.user.id,
+        })
+
+        # client message type -> handler; anything else is ignored
+        self.handlers = {
+            "message": self.on_message,
+            "ping": self.on_ping,
+            "mark_as_read": self.on_mark_as_read,
+            "typing": self.on_typing,
+            "stop_typing": self.on_stop_typing,
+            "delete_message": self.on_delete_message,
+        }
+
+        # join room (events for both sides) and our member group (events for us only)
+        await asyncio.gather(
+            self.channel_layer.group_add(
+                self.room_group_name,
+                self.channel_name
+            ),
+            self.channel_layer.group_add(
+                self.member_group_name,
+                self.channel_name
+            ),
         )
 
-        # mark online
-        await self.update_user_status(True)
-
         # notify others
         await self.channel_layer.group_send(
-            self.room_group_name,
+            self.peer_group_name,
             {
                 "type": "user_status",
-                "user_id": self.user.id,
-                "is_online": True,
+                "payload": _pack({
+                    "type": "status",
+                    "user_id": self.user.id,
+                    "is_online": True,
+                }),
             },
         )
 
         await self.accept()
 
     async def disconnect(self, close_code):
-        if hasattr(self, "room_group_name"):
-            await self.channel_layer.group_discard(
-                self.room_group_name,
-                self.channel_name
-            )
-
-        await self.update_user_status(False)
+        if not hasattr(self, "room_group_name"):
+            return
 
-        # notify others user offline
-        if hasattr(self, "room_group_name"):
-            await self.channel_layer.group_send(
+        # leave room and notify others in one round
+        await asyncio.gather(
+            self.channel_layer.group_discard(
                 self.room_group_name,
+                self.channel_name
+            ),
+            self.channel_layer.group_discard(
+                self.member_group_name,
+                self.channel_name
+            ),
+            self.channel_layer.group_send(
+                self.peer_group_name,
                 {
                     "type": "user_status",
-                    "user_id": self.user.id,
-                    "is_online": False,
+                    "payload": _pack({
+                        "type": "status",
+                        "user_id": self.user.id,
+                        "is_online": False,
+                    }),
                 },
-            )
+            ),
+        )
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if bytes_data is not None:
+            size = len(bytes_data)
+        else:
+            text_data = text_data or ""
+            size = len(text_data)
+
+            # characters are a lower bound on UTF-8 bytes; only encode frames
+            # that are under the limit in characters but could exceed it in bytes
+            if MAX_FRAME_SIZE // 4 < size <= MAX_FRAME_SIZE:
+                size = len(text_data.encode())
+
+        if not size:
+            return
+
+        # reject oversized frames before paying for deserialization
+        if size > MAX_FRAME_SIZE:
+            await self.send_error("Message too large")
+            return
 
-    async def receive(self, text_data):
         try:
-            data = json.loads(text_data)
+            if bytes_data is not None:
+                data = msgpack.unpackb(bytes_data)
+            else:
+                data = orjson.loads(text_data)
+            if not isinstance(data, dict):
+                raise ValueError("payload must be an object")
             msg_type = data.get("type", "message")
-        except json.JSONDecodeError:
-            await self.send_error("Invalid JSON")
+            if not isinstance(msg_type, str):
+                raise ValueError("type must be a string")
+        except ValueError:
+            await self.send_error("Invalid payload")
             return
         except Exception as e:
-            print(f"Receive JSON parse error: {e}")
+            print(f"Receive parse error: {e}")
             await self.send_error("Server error")
             return
-        
+
+        handler = self.handlers.get(msg_type)
+
+        if handler is None:
+            return
+
         try:
-            if msg_type == "message":
-                message_text = data.get("message", "").strip()
-
-                if not message_text:
-                    return
-
-                # save message
-                message = await self.save_message(message_text)
-
-                if not message:
-                    return
-
-                # broadcast message with ID
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        "type": "chat_message",
-                        "message_id": message.id,
-                        "message": message.content,
-                        "sender_id": self.user.id,
-                        "sender_name": self.user.username,
-                        "timestamp": message.timestamp.isoformat(),
-
-                    },
-                )
-            
-            elif msg_type == "ping":
-                await self.send(text_data=json.dumps({
-                    "type": "pong",
-                }))
-            
-            elif msg_type == "mark_as_read":
-                message_ids = data.get("message_ids", [])
-                if message_ids:
-                    await self.mark_messages_read(message_ids, self.user.id)
-                    
-                    await self.channel_layer.group_send(
-                        self.room_group_name,
-                        {
-                            "type": "message_read",
-                            "message_ids": message_ids,
-                        },
-                    )
-            
-            elif msg_type == "typing":
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        "type": "typing",
-                        "user_id": self.user.id,
-                    },
-                )
-            
-            elif msg_type == "stop_typing":
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        "type": "stop_typing",
-                        "user_id": self.user.id,
-                    },
-                )
-            
-            elif msg_type == "delete_message":
-                # Delete message
-                message_id = data.get("message_id")
-                if message_id:
-                    await self.delete_message(message_id, self.user.id)
-                    
-                    # Notify others about deletion
-                    await self.channel_layer.group_send(
-                        self.room_group_name,
-                        {
-                            "type": "deleted",
-                            "message_id": message_id,
-                        },
-                    )
+            await handler(data)
         except Exception as e:
             print(f"Receive processing error: {e}")
             await self.send_error(f"Error processing message: {str(e)}")
 
-    async def chat_message(self, event):
-        await self.send(text_data=json.dumps({
+    async def on_message(self, data):
+        message_text = data.get("message", "").strip()
+
+        if not message_text:
+            return
+
+        # save message
+        message = await self.save_message(message_text)
+
+        if not message:
+            return
+
+        await invalidate_unread(self.other_user_id)
+
+        # broadcast message with ID to every tab of both participants,
+        # encoded once for every recipient
+        payload = _pack({
             "type": "message",
-            "message_id": event["message_id"],
-            "message": event["message"],
-            "sender_id": event["sender_id"],
-            "sender_name": event["sender_name"],
-            "timestamp": event["timestamp"],
-        }))
+            "message_id": message.id,
+            "message": message.content,
+            "sender_id": self.user.id,
+            "sender_name": self.user.username,
+            # epoch ms; the client formats it
+            "timestamp": int(message.timestamp.timestamp() * 1000),
+        })
+
+        await self.channel_layer.group_send(
+            self.room_group_name,
+            {
+                "type": "chat_message",
+                "payload": payload,
+            },
+        )
+
+    async def on_ping(self, data):
+        await self.send(bytes_data=PONG_PAYLOAD)
+
+    async def on_mark_as_read(self, data):
+        message_ids = data.get("message_ids", [])
+
+        # a string such as "12" would otherwise be read as ids 1 and 2
+        if not isinstance(message_ids, list):
+            await self.send_error("Invalid message_ids")
+            return
+
+        if not message_ids:
+            return
+
+        read_ids = await self.mark_messages_read(message_ids, self.user.id)
+
+        # only broadcast messages that actually changed state
+        if read_ids:
+            await invalidate_unread(self.user.id)
+
+            await self.channel_layer.group_send(
+                self.peer_group_name,
+                {
+                    "type": "message_read",
+                    "payload": _pack({
+                        "type": "read",
+                        "message_ids": read_ids,
+                    }),
+                },
+            )
+
+    async def on_typing(self, data):
+        now = asyncio.get_running_loop().time()
+
+        # throttle repeats only; the first typing after a stop always goes out
+        if self.is_typing and now - self.last_typing_at < TYPING_INTERVAL:
+            return
+
+        self.last_typing_at = now
+        self.is_typing = True
+
+        await self.channel_layer.group_send(
+            self.peer_group_name,
+            {
+                "type": "typing",
+                "payload": self.typing_payload,
+            },
+        )
+
+    async def on_stop_typing(self, data):
+        # only the first stop after a forwarded typing matters
+        if not self.is_typing:
+            return
+
+        self.is_typing = False
+
+        await self.channel_layer.group_send(
+            self.peer_group_name,
+            {
+                "type": "stop_typing",
+                "payload": self.stop_typing_payload,
+            },
+        )
+
+    async def on_delete_message(self, data):
+        message_id = data.get("message_id")
+
+        if not message_id:
+            return
+
+        await self.delete_message(message_id, self.user.id)
+        await invalidate_unread(self.other_user_id)
+
+        payload = _pack({
+            "type": "deleted",
+            "message_id": message_id,
+        })
+
+        # Notify others about deletion
+        await self.channel_layer.group_send(
+            self.room_group_name,
+            {
+                "type": "deleted",
+                "payload": payload,
+            },
+        )
+
+    async def chat_message(self, event):
+        await self.send(bytes_data=event["payload"])
     
     async def send_error(self, error_message):
         try:
-            await self.send(text_data=json.dumps({
+            await self.send(bytes_data=_pack({
                 "type": "error",
                 "message": error_message,
             }))
@@ -249,56 +404,40 @@ class ChatConsumer(AsyncWebsocketConsumer):
             print(f"Error sending error message: {e}")
     
     async def message_read(self, event):
-        await self.send(text_data=json.dumps({
-            "type": "read",
-            "message_ids": event["message_ids"],
-        }))
+        await self.send(bytes_data=event["payload"])
 
     async def typing(self, event):
-        if event["user_id"] != self.user.id:
-            await self.send(text_data=json.dumps({
-                "type": "typing",
-                "user_id": event["user_id"],
-            }))
+        await self.send(bytes_data=event["payload"])
 
     async def stop_typing(self, event):
-        if event["user_id"] != self.user.id:
-            await self.send(text_data=json.dumps({
-                "type": "stop_typing",
-                "user_id": event["user_id"],
-            }))
+        await self.send(bytes_data=event["payload"])
 
     async def deleted(self, event):
-        await self.send(text_data=json.dumps({
-            "type": "deleted",
-            "message_id": event["message_id"],
-        }))
+        await self.send(bytes_data=event["payload"])
 
     async def user_status(self, event):
-        await self.send(text_data=json.dumps({
-            "type": "status",
-            "user_id": event["user_id"],
-            "is_online": event["is_online"],
-        }))
+        await self.send(bytes_data=event["payload"])
 
   
 
 
     @database_sync_to_async
-    def save_message(self, content):
+    def get_or_create_conversation_id(self, user1_id, user2_id):
         try:
-            other_user = User.objects.get(id=self.other_user_id)
-
-            # maintain consistent ordering
-            user1, user2 = sorted([self.user, other_user], key=lambda u: u.id)
-
             conversation, _ = Conversation.objects.get_or_create(
-                user1=user1,
-                user2=user2
+                user1_id=user1_id,
+                user2_id=user2_id
             )
+            return conversation.id
+        except Exception as e:
+            print("Conversation lookup error:", e)
+            return None
 
+    @database_sync_to_async
+    def save_message(self, content):
+        try:
             message = Message.objects.create(
-                conversation=conversation,
+                conversation_id=self.conversation_id,
                 sender=self.user,
                 content=content
             )
@@ -312,12 +451,42 @@ class ChatConsumer(AsyncWebsocketConsumer):
     @database_sync_to_async
     def mark_messages_read(self, message_ids, reader_id):
         try:
-            Message.objects.filter(
-                id__in=message_ids,
-                is_read=False
-            ).exclude(sender_id=reader_id).update(is_read=True)
+            message_ids = [int(i) for i in message_ids]
+
+            if not message_ids:
+                return []
+
+            # UPDATE ... RETURNING reports exactly the rows this call flipped
+            if connection.vendor == "postgresql" or (
+                connection.vendor == "sqlite"
+                and connection.Database.sqlite_version_info >= (3, 35)
+            ):
+                placeholders = ", ".join(["%s"] * len(message_ids))
+
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        f"UPDATE {Message._meta.db_table} SET is_read = %s "
+                        f"WHERE id IN ({placeholders}) AND conversation_id = %s "
+                        "AND is_read = %s AND sender_id <> %s "
+                        "RETURNING id",
+                        [True, *message_ids, self.conversation_id, False, reader_id],
+                    )
+                    return [row[0] for row in cursor.fetchall()]
+
+            # no RETURNING: a concurrent reader may report the same ids twice
+            read_ids = list(
+                Message.objects.filter(
+                    id__in=message_ids,
+                    conversation_id=self.conversation_id,
+                    is_read=False
+                ).exclude(sender_id=reader_id).values_list("id", flat=True)
+            )
+            Message.objects.filter(id__in=read_ids, is_read=False).update(is_read=True)
+
+            return read_ids
         except Exception as e:
             print("Mark read error:", e)
+            return []
 
     @database_sync_to_async
     def delete_message(self, message_id, user_id):
@@ -325,12 +494,3 @@ class ChatConsumer(AsyncWebsocketConsumer):
             Message.objects.filter(id=message_id, sender_id=user_id).delete()
         except Exception as e:
             print("Delete message error:", e)
-
-    @database_sync_to_async
-    def update_user_status(self, status):
-        try:
-            user = User.objects.get(id=self.user.id)
-            user.is_online = status
-            user.save(update_fields=["is_online"])
-        except Exception as e:
-            print("Status update error:", e)
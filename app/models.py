@@ -68,5 +68,11 @@ class Message(models.Model):
 
     is_read = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["conversation", "is_read", "sender"]),
+            models.Index(fields=["conversation", "timestamp"]),
+        ]
+
     def __str__(self):
         return f"{self.sender}: {self.content[:20]}"
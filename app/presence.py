@@ -0,0 +1,23 @@
+from django.core.cache import cache
+
+
+# seconds a user stays online without a heartbeat
+PRESENCE_TTL = 60
+
+
+def presence_key(user_id):
+    return f"online:{user_id}"
+
+
+async def set_online(user_id):
+    await cache.aset(presence_key(user_id), True, PRESENCE_TTL)
+
+
+async def set_offline(user_id):
+    await cache.adelete(presence_key(user_id))
+
+
+def get_online_ids(user_ids):
+    # single MGET instead of one lookup per user
+    keys = {presence_key(uid): uid for uid in user_ids}
+    return {keys[key] for key in cache.get_many(keys)}
@@ -1,3 +1,431 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+import msgpack
+import orjson
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.urls import reverse
+
+from .consumers import MAX_FRAME_SIZE
+from .models import Conversation, Message, User
+from .routing import websocket_urlpatterns
+from .unread import unread_key
+from .views import CHAT_PAGE_SIZE
+
+
+application = URLRouter(websocket_urlpatterns)
+
+
+async def connect_chat(user, other):
+    communicator = WebsocketCommunicator(application, f"/ws/chat/{other.id}/")
+    communicator.scope["user"] = user
+    connected, _ = await communicator.connect()
+    assert connected
+    return communicator
+
+
+async def drain(communicator):
+    frames = []
+    while not await communicator.receive_nothing(0.2):
+        output = await communicator.receive_output()
+        frames.append(msgpack.unpackb(output["bytes"]))
+    return frames
+
+
+class PresenceConsumerTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user("a@example.com", "a", "pw")
+
+    async def test_heartbeat_and_disconnect_write_snapshot(self):
+        communicator = WebsocketCommunicator(application, "/ws/presence/")
+        communicator.scope["user"] = self.user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.receive_output(1)
+
+        # connecting alone does not touch the database
+        user = await User.objects.aget(id=self.user.id)
+        self.assertFalse(user.is_online)
+
+        await communicator.send_to(bytes_data=msgpack.packb({"type": "ping"}))
+        await communicator.receive_nothing(0.2)
+        user = await User.objects.aget(id=self.user.id)
+        self.assertTrue(user.is_online)
+        heartbeat_seen = user.last_seen
+
+        await communicator.disconnect()
+        user = await User.objects.aget(id=self.user.id)
+        self.assertFalse(user.is_online)
+        self.assertGreaterEqual(user.last_seen, heartbeat_seen)
+
+
+class ChatConsumerReceiveTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user("a@example.com", "a", "pw")
+        self.other = User.objects.create_user("b@example.com", "b", "pw")
+
+    async def connect(self):
+        return await connect_chat(self.user, self.other)
+
+    async def assert_error(self, communicator, message):
+        output = await communicator.receive_output(1)
+        self.assertEqual(msgpack.unpackb(output["bytes"]), {"type": "error", "message": message})
+
+    async def test_unknown_type_is_ignored(self):
+        communicator = await self.connect()
+
+        await communicator.send_to(bytes_data=msgpack.packb({"type": "bogus"}))
+
+        self.assertTrue(await communicator.receive_nothing(0.2))
+        await communicator.disconnect()
+
+    async def test_unhashable_type_is_rejected(self):
+        communicator = await self.connect()
+
+        await communicator.send_to(bytes_data=msgpack.packb({"type": ["x"]}))
+        await self.assert_error(communicator, "Invalid payload")
+
+        await communicator.send_to(text_data=orjson.dumps({"type": {}}).decode())
+        await self.assert_error(communicator, "Invalid payload")
+
+        # the socket is still usable afterwards
+        await communicator.send_to(bytes_data=msgpack.packb({"type": "ping"}))
+        output = await communicator.receive_output(1)
+        self.assertEqual(msgpack.unpackb(output["bytes"]), {"type": "pong"})
+        await communicator.disconnect()
+
+    async def test_non_dict_payload_is_rejected(self):
+        communicator = await self.connect()
+
+        await communicator.send_to(bytes_data=msgpack.packb([1, 2]))
+        await self.assert_error(communicator, "Invalid payload")
+        await communicator.disconnect()
+
+    async def test_oversized_frame_is_rejected(self):
+        communicator = await self.connect()
+
+        # under the limit in characters, over it in encoded bytes
+        text = "é" * (MAX_FRAME_SIZE // 2)
+        await communicator.send_to(text_data=orjson.dumps({"type": "message", "message": text}).decode())
+        await self.assert_error(communicator, "Message too large")
+
+        # over the limit in characters is rejected without encoding
+        text = "x" * (MAX_FRAME_SIZE + 1)
+        await communicator.send_to(text_data=text)
+        await self.assert_error(communicator, "Message too large")
+
+        await communicator.send_to(bytes_data=b"x" * (MAX_FRAME_SIZE + 1))
+        await self.assert_error(communicator, "Message too large")
+
+        self.assertFalse(await Message.objects.aexists())
+        await communicator.disconnect()
+
+
+class MessagesPageTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("a@example.com", "a", "pw")
+        cls.other = User.objects.create_user("b@example.com", "b", "pw")
+        cls.outsider = User.objects.create_user("c@example.com", "c", "pw")
+
+        conversation = Conversation.objects.create(user1=cls.user, user2=cls.other)
+        cls.message_ids = [
+            Message.objects.create(
+                conversation=conversation,
+                sender=cls.user if i % 2 else cls.other,
+                content=f"message {i}",
+            ).id
+            for i in range(CHAT_PAGE_SIZE + 10)
+        ]
+
+    def get_page(self, user, other, **params):
+        self.client.force_login(user)
+        return self.client.get(reverse("messages_page", args=[other.id]), params)
+
+    def test_latest_page_oldest_first(self):
+        response = self.get_page(self.user, self.other)
+
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual([m["id"] for m in data["messages"]], self.message_ids[-CHAT_PAGE_SIZE:])
+        self.assertTrue(data["has_more"])
+
+    def test_before_id_returns_previous_page(self):
+        first_shown = self.message_ids[-CHAT_PAGE_SIZE]
+
+        data = self.get_page(self.user, self.other, before_id=first_shown).json()
+
+        self.assertEqual([m["id"] for m in data["messages"]], self.message_ids[:10])
+        self.assertFalse(data["has_more"])
+
+    def test_exact_page_has_no_more(self):
+        first_shown = self.message_ids[CHAT_PAGE_SIZE]
+
+        data = self.get_page(self.user, self.other, before_id=first_shown).json()
+
+        self.assertEqual([m["id"] for m in data["messages"]], self.message_ids[:CHAT_PAGE_SIZE])
+        self.assertFalse(data["has_more"])
+
+    def test_other_participant_sees_same_conversation(self):
+        data = self.get_page(self.other, self.user).json()
+
+        self.assertEqual([m["id"] for m in data["messages"]], self.message_ids[-CHAT_PAGE_SIZE:])
+
+    def test_invalid_before_id(self):
+        response = self.get_page(self.user, self.other, before_id="abc")
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_only_own_conversations(self):
+        for other in (self.user, self.other):
+            data = self.get_page(self.outsider, other).json()
+            self.assertEqual(data, {"messages": [], "has_more": False})
+
+    def test_login_required(self):
+        response = self.client.get(reverse("messages_page", args=[self.other.id]))
+
+        self.assertEqual(response.status_code, 302)
+
+
+class ChatConsumerTypingTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user("a@example.com", "a", "pw")
+        self.other = User.objects.create_user("b@example.com", "b", "pw")
+
+    async def send_types(self, communicator, *types):
+        for msg_type in types:
+            await communicator.send_to(bytes_data=msgpack.packb({"type": msg_type}))
+
+    async def test_repeated_typing_is_throttled(self):
+        sender = await connect_chat(self.user, self.other)
+        peer = await connect_chat(self.other, self.user)
+        await drain(sender)
+        await drain(peer)
+
+        await self.send_types(sender, "typing", "typing", "stop_typing", "stop_typing")
+
+        self.assertEqual([f["type"] for f in await drain(peer)], ["typing", "stop_typing"])
+        self.assertEqual(await drain(sender), [])
+        await sender.disconnect()
+        await peer.disconnect()
+
+    async def test_typing_after_stop_is_forwarded(self):
+        sender = await connect_chat(self.user, self.other)
+        peer = await connect_chat(self.other, self.user)
+        await drain(sender)
+        await drain(peer)
+
+        await self.send_types(sender, "typing", "stop_typing", "typing")
+
+        self.assertEqual(
+            [f["type"] for f in await drain(peer)],
+            ["typing", "stop_typing", "typing"],
+        )
+        await sender.disconnect()
+        await peer.disconnect()
+
+
+class ChatConsumerMarkReadTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user("a@example.com", "a", "pw")
+        self.other = User.objects.create_user("b@example.com", "b", "pw")
+        self.outsider = User.objects.create_user("c@example.com", "c", "pw")
+
+        conversation = Conversation.objects.create(user1=self.user, user2=self.other)
+        elsewhere = Conversation.objects.create(user1=self.user, user2=self.outsider)
+
+        self.unread = Message.objects.create(conversation=conversation, sender=self.user, content="1")
+        self.already_read = Message.objects.create(
+            conversation=conversation, sender=self.user, content="2", is_read=True
+        )
+        self.own = Message.objects.create(conversation=conversation, sender=self.other, content="3")
+        self.other_conversation = Message.objects.create(
+            conversation=elsewhere, sender=self.user, content="4"
+        )
+
+    async def mark_read(self, communicator, message_ids):
+        await communicator.send_to(bytes_data=msgpack.packb({
+            "type": "mark_as_read",
+            "message_ids": message_ids,
+        }))
+
+    async def test_only_changed_ids_are_reported(self):
+        sender = await connect_chat(self.user, self.other)
+        reader = await connect_chat(self.other, self.user)
+        await drain(sender)
+        await drain(reader)
+
+        ids = [self.unread.id, self.already_read.id, self.own.id, self.other_conversation.id]
+        await self.mark_read(reader, ids)
+
+        self.assertEqual(await drain(sender), [{"type": "read", "message_ids": [self.unread.id]}])
+        self.assertFalse(await Message.objects.filter(id=self.own.id, is_read=True).aexists())
+        self.assertFalse(
+            await Message.objects.filter(id=self.other_conversation.id, is_read=True).aexists()
+        )
+
+        # nothing left to change the second time round
+        await self.mark_read(reader, ids)
+        self.assertEqual(await drain(sender), [])
+
+        await sender.disconnect()
+        await reader.disconnect()
+
+    async def test_string_ids_are_rejected(self):
+        reader = await connect_chat(self.other, self.user)
+        await drain(reader)
+
+        await self.mark_read(reader, str(self.unread.id))
+
+        self.assertEqual(await drain(reader), [{"type": "error", "message": "Invalid message_ids"}])
+        self.assertFalse(await Message.objects.filter(id=self.unread.id, is_read=True).aexists())
+        await reader.disconnect()
+
+
+class ChatConsumerMarkReadFallbackTests(ChatConsumerMarkReadTests):
+    """Same checks on the select/update path used without RETURNING."""
+
+    def setUp(self):
+        super().setUp()
+        if connection.vendor != "sqlite":
+            self.skipTest("fallback is exercised through the SQLite version check")
+        patcher = mock.patch.object(connection.Database, "sqlite_version_info", (3, 34, 0))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class ChatConsumerRoutingTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user("a@example.com", "a", "pw")
+        self.other = User.objects.create_user("b@example.com", "b", "pw")
+
+    async def send(self, communicator, data):
+        await communicator.send_to(bytes_data=msgpack.packb(data))
+
+    async def types(self, communicator):
+        return [frame["type"] for frame in await drain(communicator)]
+
+    async def test_event_recipients(self):
+        tab1 = await connect_chat(self.user, self.other)
+        tab2 = await connect_chat(self.user, self.other)
+        await drain(tab1)
+
+        # status goes to the other participant only
+        peer = await connect_chat(self.other, self.user)
+        self.assertEqual(await self.types(tab1), ["status"])
+        self.assertEqual(await self.types(tab2), ["status"])
+        self.assertEqual(await self.types(peer), [])
+
+        # messages reach every tab of both participants exactly once
+        await self.send(tab1, {"type": "message", "message": "hi"})
+        for communicator in (tab1, tab2, peer):
+            self.assertEqual(await self.types(communicator), ["message"])
+
+        message = await Message.objects.aget()
+
+        # read receipts go to the sender's tabs only
+        await self.send(peer, {"type": "mark_as_read", "message_ids": [message.id]})
+        self.assertEqual(await self.types(tab1), ["read"])
+        self.assertEqual(await self.types(tab2), ["read"])
+        self.assertEqual(await self.types(peer), [])
+
+        # deletions reach every tab of both participants exactly once
+        await self.send(tab1, {"type": "delete_message", "message_id": message.id})
+        for communicator in (tab1, tab2, peer):
+            self.assertEqual(await self.types(communicator), ["deleted"])
+
+        await peer.disconnect()
+        self.assertEqual(await self.types(tab1), ["status"])
+
+        await tab1.disconnect()
+        await tab2.disconnect()
+
+    async def test_chat_with_self_delivers_once(self):
+        communicator = await connect_chat(self.user, self.user)
+        await drain(communicator)
+
+        await self.send(communicator, {"type": "message", "message": "note"})
+
+        self.assertEqual(await self.types(communicator), ["message"])
+        await communicator.disconnect()
+
+
+class UnreadCountsCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("a@example.com", "a", "pw")
+        self.other = User.objects.create_user("b@example.com", "b", "pw")
+        self.conversation = Conversation.objects.create(user1=self.user, user2=self.other)
+
+    def test_counts_are_served_from_cache(self):
+        self.client.force_login(self.user)
+        url = reverse("unread_counts")
+
+        Message.objects.create(conversation=self.conversation, sender=self.other, content="1")
+        self.assertEqual(self.client.get(url).json(), {str(self.other.id): 1})
+
+        # written behind the consumer's back, so the cached value is still served
+        Message.objects.create(conversation=self.conversation, sender=self.other, content="2")
+        self.assertEqual(self.client.get(url).json(), {str(self.other.id): 1})
+
+        cache.delete(unread_key(self.user.id))
+        self.assertEqual(self.client.get(url).json(), {str(self.other.id): 2})
+
+
+class ChatConsumerUnreadInvalidationTests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("a@example.com", "a", "pw")
+        self.other = User.objects.create_user("b@example.com", "b", "pw")
+
+    async def prime(self):
+        await cache.aset_many({
+            unread_key(self.user.id): "cached",
+            unread_key(self.other.id): "cached",
+        })
+
+    async def cached_users(self):
+        keys = {unread_key(self.user.id): self.user.id, unread_key(self.other.id): self.other.id}
+        return {keys[key] for key in await cache.aget_many(keys)}
+
+    async def send(self, communicator, data):
+        await communicator.send_to(bytes_data=msgpack.packb(data))
+
+    async def test_only_affected_users_key_is_cleared(self):
+        sender = await connect_chat(self.user, self.other)
+        reader = await connect_chat(self.other, self.user)
+        await drain(sender)
+
+        # sending raises the recipient's count
+        await self.prime()
+        await self.send(sender, {"type": "message", "message": "hi"})
+        await drain(reader)
+        self.assertEqual(await self.cached_users(), {self.user.id})
+
+        message = await Message.objects.aget()
+
+        # reading lowers the reader's count
+        await self.prime()
+        await self.send(reader, {"type": "mark_as_read", "message_ids": [message.id]})
+        await drain(sender)
+        self.assertEqual(await self.cached_users(), {self.user.id})
+
+        # deleting can lower the recipient's count
+        await self.prime()
+        await self.send(sender, {"type": "delete_message", "message_id": message.id})
+        await drain(reader)
+        self.assertEqual(await self.cached_users(), {self.user.id})
+
+        await sender.disconnect()
+        await reader.disconnect()
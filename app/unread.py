@@ -0,0 +1,36 @@
+from django.core.cache import cache
+from django.db.models import Count, Q
+
+from .models import Conversation, Message
+
+
+# unread badges are polled every few seconds; absorb bursts
+UNREAD_TTL = 2
+
+
+def unread_key(user_id):
+    return f"unread:{user_id}"
+
+
+def unread_counts_for(user):
+    def compute():
+        conversations = Conversation.objects.filter(
+            Q(user1=user) | Q(user2=user)
+        )
+
+        # one grouped query, keyed by the other user's id
+        rows = (
+            Message.objects
+            .filter(conversation__in=conversations, is_read=False)
+            .exclude(sender=user)
+            .values("sender_id")
+            .annotate(unread=Count("id"))
+        )
+
+        return {row["sender_id"]: row["unread"] for row in rows}
+
+    return cache.get_or_set(unread_key(user.id), compute, UNREAD_TTL)
+
+
+async def invalidate_unread(user_id):
+    await cache.adelete(unread_key(user_id))
@@ -9,4 +9,5 @@ urlpatterns = [
     path("users/", user_list, name="user_list"),
     path("chat/<int:user_id>/", chat_view, name="chat"),
     path("api/unread-counts/", get_unread_counts, name="unread_counts"),
+    path("api/messages/<int:user_id>/", messages_page, name="messages_page"),
 ]
@@ -1,11 +1,13 @@
+import orjson
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import login, logout, authenticate
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.utils import timezone
-from django.http import JsonResponse
-from django.db.models import Count, Q
+from django.http import HttpResponse, JsonResponse
 from .models import User, Conversation, Message
+from .presence import get_online_ids
+from .unread import unread_counts_for
 
 
 def register_view(request):
@@ -57,46 +59,97 @@ def logout_view(request):
 
 @login_required
 def user_list(request):
-    users = User.objects.exclude(id=request.user.id)
+    users = list(User.objects.exclude(id=request.user.id).only("id", "username"))
+
+    online_ids = get_online_ids([u.id for u in users])
+    for u in users:
+        u.is_online = u.id in online_ids
+
     return render(request, "user_list.html", {"users": users})
 
 
 
+# messages rendered on open and returned per older-history fetch
+CHAT_PAGE_SIZE = 50
+
+
+def _message_window(conversation_id, before_id=None):
+    # newest page first from the DB, returned oldest-first for display
+    qs = (
+        Message.objects
+        .filter(conversation_id=conversation_id)
+        .select_related("sender")
+        .only("id", "content", "timestamp", "is_read", "sender__id", "sender__username")
+        # id is both the sort key and the cursor, so pages never overlap or skip
+        .order_by("-id")
+    )
+
+    if before_id is not None:
+        qs = qs.filter(id__lt=before_id)
+
+    # one extra row tells us whether an older page exists
+    page = list(qs[:CHAT_PAGE_SIZE + 1])
+    has_more = len(page) > CHAT_PAGE_SIZE
+    page = page[:CHAT_PAGE_SIZE]
+    page.reverse()
+    return page, has_more
+
+
 @login_required
 def chat_view(request, user_id):
     other_user = get_object_or_404(User, id=user_id)
+    other_user.is_online = other_user.id in get_online_ids([other_user.id])
 
     conversation, created = Conversation.objects.get_or_create(
         user1=min(request.user, other_user, key=lambda u: u.id),
         user2=max(request.user, other_user, key=lambda u: u.id),
     )
 
-    messages = conversation.messages.all().order_by("timestamp")
+    messages, has_more = _message_window(conversation.id)
 
     return render(request, "chat.html", {
         "other_user": other_user,
-        "messages": messages
+        "messages": messages,
+        "has_more": has_more,
     })
 
 
+@login_required
+def messages_page(request, user_id):
+    user1_id, user2_id = sorted([request.user.id, user_id])
+
+    conversation = Conversation.objects.filter(
+        user1_id=user1_id,
+        user2_id=user2_id
+    ).only("id").first()
+
+    if conversation is None:
+        return HttpResponse(orjson.dumps({"messages": [], "has_more": False}),
+                            content_type="application/json")
+
+    try:
+        before_id = int(request.GET["before_id"]) if "before_id" in request.GET else None
+    except ValueError:
+        return HttpResponse(orjson.dumps({"error": "Invalid before_id"}),
+                            content_type="application/json", status=400)
+
+    page, has_more = _message_window(conversation.id, before_id)
+
+    return HttpResponse(orjson.dumps({
+        "messages": [
+            {
+                "id": m.id,
+                "message": m.content,
+                "sender_id": m.sender.id,
+                "timestamp": int(m.timestamp.timestamp() * 1000),
+                "is_read": m.is_read,
+            }
+            for m in page
+        ],
+        "has_more": has_more,
+    }), content_type="application/json")
+
+
 @login_required
 def get_unread_counts(request):
-    unread_counts = {}
-    
-    conversations = Conversation.objects.filter(
-        Q(user1=request.user) | Q(user2=request.user)
-    )
-    
-    for conv in conversations:
-        other_user = conv.user2 if conv.user1 == request.user else conv.user1
-        
-        unread = Message.objects.filter(
-            conversation=conv,
-            sender=other_user,
-            is_read=False
-        ).count()
-        
-        if unread > 0:
-            unread_counts[other_user.id] = unread
-    
-    return JsonResponse(unread_counts)
+    return JsonResponse(unread_counts_for(request.user))
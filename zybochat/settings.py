@@ -84,6 +84,8 @@ WSGI_APPLICATION = 'zybochat.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# Switching ENGINE to django.db.backends.postgresql enables the psycopg
+# connection pool below, which needs "psycopg[pool]" added to requirements.txt.
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
@@ -158,6 +160,16 @@ CHANNEL_LAYERS = {
     }
 }
 
+# CACHE CONFIGURATION
+# Holds presence flags and short-lived unread counts. Unread counts are
+# invalidated by the chat consumer, which only reaches other processes through a
+# shared cache: use RedisCache when running more than one worker
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache"
+    }
+}
+
 # ASGI configuration
 ASGI_THREADS = 4
 
@@ -169,6 +181,12 @@ ASGI_APPLICATION = "zybochat.asgi.application"
 
 
 
-DATABASES['default']['CONN_MAX_AGE'] = 60
+if DATABASES['default']['ENGINE'] == 'django.db.backends.postgresql':
+    # pooling replaces persistent connections
+    DATABASES['default'].setdefault('OPTIONS', {})['pool'] = True
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+else:
+    DATABASES['default']['CONN_MAX_AGE'] = 60
+    DATABASES['default']['CONN_HEALTH_CHECKS'] = True
 
 